@@ -1,16 +1,32 @@
+import aiohttp
+import asyncio
+import base64
+import httpx
+import json
 import openai
-import requests
 import os
-from io import BytesIO
-from datetime import datetime
-from flask import Flask, request, jsonify
-from requests_oauthlib import OAuth1Session
-from requests_oauthlib import OAuth1
+from aiolimiter import AsyncLimiter
+from datetime import datetime, timedelta, timezone
+from oauthlib.oauth1 import Client
+from quart import Quart, request, jsonify
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
-app = Flask(__name__)
+app = Quart(__name__)
 
-# Initialize OpenAI using environment variables
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# OpenAI client, created in open_http_session from environment variables so the module imports without them.
+# One client is kept for the app's lifetime so its pooled HTTP/2 connections are reused; retries are left to
+# retry_transient below.
+client = None
+
+# Every OpenAI request takes a slot from the semaphore and the rate limiter, so concurrent posts stay under
+# the account's rate limits instead of bursting into 429s and retry-after waits
+OPENAI_SEMA = asyncio.Semaphore(int(os.getenv('OPENAI_MAX_CONCURRENCY', 5)))
+OPENAI_LIMITER = AsyncLimiter(int(os.getenv('OPENAI_RPM', 500)), time_period=60)
+
+# Image generations take around 10s and have their own, much lower limits, so they get separate slots rather
+# than starving the quick moderation and chat calls
+IMAGE_SEMA = asyncio.Semaphore(int(os.getenv('OPENAI_IMAGE_MAX_CONCURRENCY', 2)))
+IMAGE_LIMITER = AsyncLimiter(int(os.getenv('OPENAI_IMAGES_PER_MINUTE', 5)), time_period=60)
 
 # Setup for Twitter API credentials
 consumer_key = os.getenv('TWITTER_API_KEY')
@@ -20,137 +36,437 @@ access_token_secret = os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
 
 # Twitter API v2 endpoint for creating tweets with OAuth1 authentication
 create_tweet_url = "https://api.twitter.com/2/tweets"
-auth = OAuth1(consumer_key, consumer_secret, access_token, access_token_secret)
+auth = Client(consumer_key, client_secret=consumer_secret, resource_owner_key=access_token, resource_owner_secret=access_token_secret)
+
+# Twitter session, opened once on the app's event loop so TLS connections to the upload and tweet
+# endpoints stay alive across /post calls; every request through it is signed with the OAuth1 client above
+TWITTER_SESSION = None
+
+@app.before_serving
+async def open_http_session():
+    global TWITTER_SESSION, client
+    TWITTER_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=10, limit_per_host=4))
+    client = openai.AsyncOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        max_retries=0,
+        http_client=httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)),
+    )
+
+@app.after_serving
+async def close_http_session():
+    await TWITTER_SESSION.close()
+    await client.close()
 
-def is_safe_prompt(prompt):
+def oauth_headers(url, http_method='POST'):
     """
-    Evaluates if the generated prompt passes OpenAI's content filter, ensuring it adheres to content guidelines.
+    Signs a Twitter API request with the OAuth1 credentials and returns the headers to send with it.
     """
+    _, headers, _ = auth.sign(url, http_method=http_method)
+    return headers
+
+# Rate limits, 5xx responses and dropped connections from OpenAI or Twitter are worth retrying
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientResponseError,
+)
+
+backoff = wait_exponential_jitter(initial=1, max=30)
+
+def wait_retry_after(retry_state):
+    """
+    Waits for the server's retry-after hint when one is given, otherwise backs off exponentially with jitter.
+    """
+    exception = retry_state.outcome.exception()
+    # aiohttp errors carry the headers themselves, OpenAI errors on their httpx response
+    headers = getattr(exception, 'headers', None) or getattr(getattr(exception, 'response', None), 'headers', None) or {}
     try:
-        response = openai.Completion.create(
-            engine="content-filter-alpha-c4",
-            prompt=f"{prompt}\n--\nLabel:",
-            temperature=0,
-            max_tokens=1,
-            top_p=1,
-            logprobs=10
-        )
-        output_label = response.choices[0].text.strip()
-        # "2" indicates unsafe content
-        return output_label != "2"
+        return min(float(headers.get('retry-after')), 30)
+    except (TypeError, ValueError):
+        return backoff(retry_state)
+
+def is_transient(exception):
+    """
+    Decides whether a failed call is worth retrying; a success status with an unexpected body won't change on retry.
+    """
+    return isinstance(exception, TRANSIENT_ERRORS) and not isinstance(exception, aiohttp.ContentTypeError)
+
+def is_retryable_tweet_error(exception):
+    """
+    Creating a tweet isn't idempotent, so it's only retried when Twitter rate-limited the request or the connection never opened.
+    """
+    if isinstance(exception, aiohttp.ClientConnectorError):
+        return True
+    return isinstance(exception, aiohttp.ClientResponseError) and not isinstance(exception, aiohttp.ContentTypeError) and exception.status == 429
+
+retry_transient = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_retry_after,
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+
+retry_tweet = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_retry_after,
+    retry=retry_if_exception(is_retryable_tweet_error),
+    reraise=True,
+)
+
+def raise_for_transient_status(response):
+    """
+    Raises for rate-limited and server error responses so they are retried, leaving other failures to the caller.
+    """
+    if response.status == 429 or response.status >= 500:
+        response.raise_for_status()
+
+@retry_transient
+async def is_safe_prompt(*texts):
+    """
+    Evaluates if the generated prompt and tweet text pass OpenAI's moderation check in one call, ensuring they adhere to content guidelines.
+    """
+    try:
+        async with OPENAI_SEMA, OPENAI_LIMITER:
+            response = await client.moderations.create(input=list(texts))
+        return not any(result.flagged for result in response.results)
+    except TRANSIENT_ERRORS:
+        raise
     except Exception as e:
         print(f"Content filter error: {e}")
         return False
 
-def generate_prompt_with_chatgpt(attempts=3):
+def fit_to_tweet(text, max_length=280):
     """
-    Generates creative and safe prompts with ChatGPT, retrying up to 3 times for content that passes the safety filter.
+    Truncates text to Twitter's character limit, marking the cut with an ellipsis.
     """
-    for attempt in range(attempts):
-        today = datetime.now().strftime("%B %d")
-        prompt_text = f"Generate a creative and weird prompt for image generation based on significant historical events that occurred in the past on {today}."
-        response = openai.Completion.create(
-            engine="gpt-3.5-turbo-instruct",
-            prompt=prompt_text,
-            temperature=0.7,
-            max_tokens=100,
-            top_p=1.0,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
-        )
-        generated_prompt = response.choices[0].text.strip()
-        if is_safe_prompt(generated_prompt):
-            return generated_prompt
-        print(f"Attempt {attempt + 1}: Unsafe prompt generated, retrying...")
-    return "Unable to generate a safe prompt after multiple attempts."
+    return text[:max_length - 3] + "..." if len(text) > max_length else text
 
-def summarize_prompt_with_chatgpt(original_prompt, max_length=280):
+def parse_prompt_and_tweet(text, max_length=280):
     """
-    Condenses the generated prompt to fit Twitter's character limit, ensuring it's suitable for tweet summaries.
+    Extracts the image prompt and tweet text from a combined completion, returning None when the reply is malformed.
     """
     try:
-        instruction = f"Summarize the following in less than {max_length} characters for a Tweet:\n\n{original_prompt}. Include relevant hashtags like #AI, #TodayInHistory, and anything relevant to the theme."
-        response = openai.Completion.create(
-            engine="gpt-3.5-turbo-instruct",
-            prompt=instruction,
-            temperature=0.7,
-            max_tokens=100,
-            top_p=1.0,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
-        )
-        summary = response.choices[0].text.strip()
-        if len(summary) > max_length:
-            summary = summary[:max_length - 3] + "..."
-        return summary
-    except Exception as e:
-        print(f"Error summarizing prompt: {e}")
-        return original_prompt[:max_length - 3] + "..." if len(original_prompt) > max_length else original_prompt
+        data = json.loads(text)
+        prompt = data["prompt"].strip()
+        tweet = data.get("tweet", "").strip() or prompt
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Error parsing combined completion: {e}")
+        return None
+    if not prompt:
+        print("Error parsing combined completion: empty prompt")
+        return None
+    return prompt, fit_to_tweet(tweet, max_length)
 
-def generate_image_with_dalle(prompt):
+# Keeps the image prompt short enough for the whole reply to fit a tight max_tokens
+IMAGE_PROMPT_MAX_LENGTH = 250
+
+def completion_params(day, max_length=280):
     """
-    Creates a visual representation of the prompt using OpenAI's DALL·E, returning the image URL.
+    Builds the chat completion request asking for an image prompt about the given day's history along with its tweet summary.
     """
-    response = openai.Image.create(
-        prompt=prompt,
-        n=1,
-        size="1024x1024"
+    prompt_text = (
+        f"Generate a creative and weird prompt of less than {IMAGE_PROMPT_MAX_LENGTH} characters for image generation based on significant historical events that occurred in the past on {day.strftime('%B %d')}. "
+        f"Then summarize that prompt in less than {max_length} characters for a Tweet, including relevant hashtags like #AI, #TodayInHistory, and anything relevant to the theme.\n"
+        'Respond only with JSON of the form {"prompt": "<image prompt>", "tweet": "<tweet text>"}.'
     )
-    image_data = response['data'][0]
-    return image_data['url']
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt_text}],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.7,
+        # Both texts are capped in the instruction: ~65 tokens for the prompt, up to ~90 for a hashtag-heavy
+        # 280-character tweet, plus the JSON around them. Replies cut off at this limit are rejected, not parsed.
+        "max_tokens": 180,
+        "top_p": 1.0,
+        "frequency_penalty": 0.0,
+        "presence_penalty": 0.0,
+    }
+
+@retry_transient
+async def request_prompt_and_tweet(today, max_length=280):
+    """
+    Asks ChatGPT for an image prompt about the given day's history along with its tweet summary, in a single call.
+    Returns None when the reply can't be used.
+    """
+    async with OPENAI_SEMA, OPENAI_LIMITER:
+        response = await client.chat.completions.create(**completion_params(today, max_length))
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        print("Completion was cut off at max_tokens")
+        return None
+    content = choice.message.content
+    if not content:
+        # Refusals come back without any content
+        print("Completion returned no content")
+        return None
+    return parse_prompt_and_tweet(content.strip(), max_length)
+
+# Safe prompts and tweets generated for a day but never posted, so a retry after a failed post skips ChatGPT.
+# Entries are taken out when used: Twitter rejects duplicate tweet text, so posted text is never handed out again.
+prompt_cache = {}
+
+def keep_unposted_prompt(day, prompt, post_title):
+    """
+    Puts back a day's prompt and tweet that failed to post, for the next post that day to reuse.
+    """
+    # Earlier days' entries will never be hit again
+    prompt_cache.clear()
+    prompt_cache[day] = (prompt, post_title)
+
+async def generate_prompt_with_chatgpt(today, attempts=3, max_length=280):
+    """
+    Generates a creative and safe prompt together with its tweet summary for the given date, retrying up to 3 times for content that passes the safety filter.
+    Returns None when every attempt fails.
+    """
+    if today in prompt_cache:
+        return prompt_cache.pop(today)
+    for attempt in range(attempts):
+        result = await request_prompt_and_tweet(today, max_length)
+        if result is None:
+            print(f"Attempt {attempt + 1}: Malformed completion, retrying...")
+            continue
+        generated_prompt, post_title = result
+        if await is_safe_prompt(generated_prompt, post_title):
+            return generated_prompt, post_title
+        print(f"Attempt {attempt + 1}: Unsafe prompt generated, retrying...")
+    return None
 
-def download_image(url):
+@retry_transient
+async def generate_image_with_dalle(prompt):
     """
-    Downloads an image from the specified URL and returns it as a bytes object for uploading.
+    Creates a visual representation of the prompt using OpenAI's DALL·E, returning the raw image bytes.
     """
-    response = requests.get(url)
-    response.raise_for_status()
-    return BytesIO(response.content)
+    async with IMAGE_SEMA, IMAGE_LIMITER:
+        response = await client.images.generate(
+            prompt=prompt,
+            n=1,
+            size="1024x1024",
+            response_format="b64_json"
+        )
+    return base64.b64decode(response.data[0].b64_json)
 
-def upload_media(image_url):
+@retry_transient
+async def upload_media(image_bytes):
     """
     Uploads an image to Twitter and returns the media ID for reference in tweets.
     """
     upload_url = 'https://upload.twitter.com/1.1/media/upload.json'
-    response = requests.get(image_url)
-    files = {'media': response.content}
-    response = requests.post(upload_url, auth=auth, files=files)
-    if response.status_code == 200:
-        return response.json().get('media_id_string')
-    print("Failed to upload media:", response.text)
+    form = aiohttp.FormData()
+    form.add_field('media', image_bytes)
+    async with TWITTER_SESSION.post(upload_url, headers=oauth_headers(upload_url), data=form) as response:
+        raise_for_transient_status(response)
+        if response.status == 200:
+            return (await response.json()).get('media_id_string')
+        print("Failed to upload media:", await response.text())
     return None
 
-def post_tweet_v2(content, media_id):
+@retry_tweet
+async def post_tweet_v2(content, media_id):
     """
     Posts a tweet with the provided content and attached media using Twitter API v2.
     """
     try:
-        twitter_session = OAuth1Session(consumer_key, consumer_secret, access_token, access_token_secret)
-        response = twitter_session.post(create_tweet_url, json={"text": content, "media":{"media_ids": [media_id]}})
-        if response.status_code == 201:
-            tweet_data = response.json()
-            return f"https://twitter.com/user/status/{tweet_data['data']['id']}"
-        print(f"Failed to post tweet: {response.status_code}, {response.text}")
+        async with TWITTER_SESSION.post(create_tweet_url, headers=oauth_headers(create_tweet_url), json={"text": content, "media":{"media_ids": [media_id]}}) as response:
+            if response.status == 429:
+                response.raise_for_status()
+            if response.status == 201:
+                tweet_data = await response.json()
+                return f"https://twitter.com/user/status/{tweet_data['data']['id']}"
+            print(f"Failed to post tweet: {response.status}, {await response.text()}")
     except Exception as e:
+        if is_retryable_tweet_error(e):
+            raise
         print(f"Error posting to Twitter: {e}")
     return None
 
+def batch_custom_id(day):
+    """
+    Identifies a day's request within a prompt batch.
+    """
+    return f"prompt-{day.isoformat()}"
+
+@retry_transient
+async def upload_batch_input(lines):
+    """
+    Uploads the JSONL requests for a batch and returns the ID of the created file.
+    """
+    async with OPENAI_SEMA, OPENAI_LIMITER:
+        input_file = await client.files.create(file=("prompts.jsonl", "\n".join(lines).encode()), purpose="batch")
+    return input_file.id
+
+@retry_transient
+async def create_batch(input_file_id):
+    """
+    Starts a batch of chat completion requests from an uploaded input file, to finish within 24 hours.
+    """
+    async with OPENAI_SEMA, OPENAI_LIMITER:
+        return await client.batches.create(input_file_id=input_file_id, endpoint="/v1/chat/completions", completion_window="24h")
+
+async def submit_prompt_batch(start, days, max_length=280):
+    """
+    Queues one prompt and tweet completion per day from the start date on OpenAI's Batch API and returns the created batch.
+    """
+    lines = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        lines.append(json.dumps({
+            "custom_id": batch_custom_id(day),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": completion_params(day, max_length),
+        }))
+    input_file_id = await upload_batch_input(lines)
+    return await create_batch(input_file_id)
+
+@retry_transient
+async def retrieve_batch(batch_id):
+    """
+    Fetches a batch's current status and, once completed, its output file ID.
+    """
+    async with OPENAI_SEMA, OPENAI_LIMITER:
+        return await client.batches.retrieve(batch_id)
+
+@retry_transient
+async def download_batch_prompts(output_file_id, max_length=280):
+    """
+    Downloads a finished batch's output and returns the parsed prompt and tweet for each day, keyed by custom ID.
+    """
+    async with OPENAI_SEMA, OPENAI_LIMITER:
+        output = await client.files.content(output_file_id)
+    prompts = {}
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        if result.get("error") or result["response"]["status_code"] != 200:
+            print(f"Batch request {result['custom_id']} failed: {result.get('error') or result['response']}")
+            continue
+        choice = result["response"]["body"]["choices"][0]
+        if choice.get("finish_reason") == "length":
+            print(f"Batch request {result['custom_id']} was cut off at max_tokens, skipping")
+            continue
+        text = choice["message"].get("content") or ""
+        parsed = parse_prompt_and_tweet(text.strip(), max_length)
+        if parsed is None:
+            print(f"Batch request {result['custom_id']} returned a malformed completion, skipping")
+            continue
+        prompts[result["custom_id"]] = parsed
+    return prompts
+
+def no_safe_prompt_response():
+    """
+    Builds the endpoint response for when no usable, safe prompt could be generated, so nothing is posted.
+    """
+    return jsonify({"error": "Unable to generate a safe prompt after multiple attempts."}), 502
+
+async def publish_prompt(day, prompt, post_title):
+    """
+    Creates the image for a prompt, uploads it to Twitter and posts the tweet.
+    Returns whether the tweet went out along with the endpoint's response.
+    """
+    try:
+        media_bytes = await generate_image_with_dalle(prompt)
+        media_id = await upload_media(media_bytes)
+        tweet_url = await post_tweet_v2(post_title, media_id)
+    except Exception:
+        keep_unposted_prompt(day, prompt, post_title)
+        raise
+    if tweet_url:
+        return True, (jsonify({"message": "Tweet successfully posted.", "details": {"tweet_url": tweet_url, "prompt": prompt, "post_title": post_title, "media_id": media_id}}), 200)
+    keep_unposted_prompt(day, prompt, post_title)
+    return False, (jsonify({"message": "Failed to post tweet.", "details": {"prompt": prompt, "post_title": post_title, "media_id": media_id}}), 200)
+
 @app.route('/post', methods=['GET'])
-def run_bot_and_post():
+async def run_bot_and_post():
+    """
+    Initiates the bot's workflow to generate a prompt and its tweet summary, create an image, upload the image to Twitter, and post the tweet.
+    """
+    try:
+        # Computed once so retries, the cache key and the prompt all agree on the date, even around midnight
+        today = datetime.now(timezone.utc).date()
+        result = await generate_prompt_with_chatgpt(today)
+        if result is None:
+            return no_safe_prompt_response()
+        prompt, post_title = result
+        _, response = await publish_prompt(today, prompt, post_title)
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/batch/submit', methods=['GET'])
+async def submit_batch():
+    """
+    Queues the prompts for the next few days, starting tomorrow (7 by default, 1 to 31 with ?days=), on OpenAI's Batch API, for scheduled posting at batch pricing.
+    """
+    try:
+        days = int(request.args.get('days', 7))
+    except ValueError:
+        days = 0
+    if not 1 <= days <= 31:
+        return jsonify({"error": "days must be a whole number between 1 and 31."}), 400
+    try:
+        # A batch can take up to 24 hours, so today's entry would usually arrive too late to post
+        tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
+        batch = await submit_prompt_batch(tomorrow, days)
+        return jsonify({"message": "Batch submitted.", "details": {"batch_id": batch.id, "status": batch.status}}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Batch days that have a tweet posted or in flight. Batches are scheduled as one post per day, so a day is
+# posted from batches at most once; otherwise every poll would republish the same entry.
+posted_batch_days = set()
+
+# Batches still working towards a result; completed, expired, cancelled and failed ones are final, and the
+# first three may carry a (possibly partial) output file
+PENDING_BATCH_STATUSES = {"validating", "in_progress", "finalizing", "cancelling"}
+
+def batch_already_posted_response(batch_id, custom_id):
+    """
+    Builds the endpoint response for a batch day whose tweet is already posted or in flight.
+    """
+    return jsonify({"message": "Today's batch prompt was already posted.", "details": {"batch_id": batch_id, "custom_id": custom_id}}), 200
+
+@app.route('/batch/<batch_id>/post', methods=['GET'])
+async def post_from_batch(batch_id):
     """
-    Initiates the bot's workflow to generate a prompt, create an image, summarize for a tweet, upload the image to Twitter, and post the tweet.
+    Posts today's tweet from a finished prompt batch, so only the image is generated at request time.
     """
     try:
-        prompt = generate_prompt_with_chatgpt()
-        image_url = generate_image_with_dalle(prompt)
-        post_title = summarize_prompt_with_chatgpt(prompt)
-        media_id = upload_media(image_url)
-        tweet_url = post_tweet_v2(post_title, media_id)
-        if tweet_url:
-            return jsonify({"message": "Tweet successfully posted.", "details": {"tweet_url": tweet_url, "prompt": prompt, "image_url": image_url, "post_title": post_title, "media_id": media_id}}), 200
-        return jsonify({"message": "Failed to post tweet.", "details": {"prompt": prompt, "image_url": image_url, "post_title": post_title, "media_id": media_id}}), 200
+        today = datetime.now(timezone.utc).date()
+        custom_id = batch_custom_id(today)
+        if custom_id in posted_batch_days:
+            return batch_already_posted_response(batch_id, custom_id)
+        batch = await retrieve_batch(batch_id)
+        if batch.status in PENDING_BATCH_STATUSES:
+            return jsonify({"message": "Batch is not completed yet.", "details": {"batch_id": batch_id, "status": batch.status}}), 202
+        if not batch.output_file_id:
+            # Failed batches, and finished ones where every request failed, have no output to post from
+            return jsonify({"message": "Batch finished without any successful requests.", "details": {"batch_id": batch_id, "status": batch.status, "error_file_id": batch.error_file_id}}), 502
+        prompts = await download_batch_prompts(batch.output_file_id)
+        if custom_id not in prompts:
+            return jsonify({"message": "Batch has no prompt for today.", "details": {"batch_id": batch_id, "custom_id": custom_id}}), 404
+        prompt, post_title = prompts[custom_id]
+        if custom_id in posted_batch_days:
+            return batch_already_posted_response(batch_id, custom_id)
+        posted_batch_days.add(custom_id)
+        posted = False
+        try:
+            if not await is_safe_prompt(prompt, post_title):
+                # Fall back to the interactive path rather than posting flagged content
+                result = await generate_prompt_with_chatgpt(today)
+                if result is None:
+                    return no_safe_prompt_response()
+                prompt, post_title = result
+            posted, response = await publish_prompt(today, prompt, post_title)
+            return response
+        finally:
+            if not posted:
+                posted_batch_days.discard(custom_id)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Local development only; deployments serve the app with gunicorn and a single uvicorn worker (see Procfile).
+# One event loop already handles concurrent posts, and the prompt cache, posted batch days and OpenAI limits are all
+# per process, so extra workers would split the cache and multiply the limits.
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=int(os.getenv('PORT', 8080)))
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 8080)), use_reloader=False)